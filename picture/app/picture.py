@@ -15,142 +15,357 @@
 # This file is provided AS IS with NO WARRANTY OF ANY KIND, INCLUDING THE
 # WARRANTY OF DESIGN, MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE.
 
+import aiofiles
 import aiohttp
 import aiohttp_jinja2
 import aiohttp_session
 import aiohttp_session.cookie_storage
 import asyncio
+import atexit
 import base64
+import collections
+import concurrent.futures
+import contextlib
 import cryptography.fernet
-import hashlib
+import errno
+import functools
 import jinja2
-import json
 import locale
-import math
+import logging
+import logging.handlers
+import mimetypes
+import orjson
 import os
+import queue
 import re
 import shutil
-import si_prefix
 import sqlite3
 import sys
+import tempfile
+import threading
 import time
+import urllib.parse
 import uuid
 
 from PIL import Image
 from PIL import ExifTags
+from PIL import TiffImagePlugin
 
 
 # Require Python 3.6+
 assert sys.version_info >= (3, 6)
 
+# Log records are written to stdout by a background thread, not by the event loop
+log_queue = queue.Queue()
+log_handler = logging.StreamHandler(sys.stdout)
+log_handler.setFormatter(logging.Formatter('[%(asctime)s] %(message)s', '%Y-%m-%d %H:%M:%S'))
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+logger = logging.getLogger('picture')
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+logger.propagate = False
 
-class Database:
 
-    def __init__(self, dbfile: str):
-        self.conn = sqlite3.connect(dbfile)
-        self.conn.row_factory = sqlite3.Row
-        self.create_tables()
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Database initialized ({dbfile})")
+def in_executor(method):
+    # Run a blocking method in the default thread pool and await its result
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        return await asyncio.get_event_loop().run_in_executor(None, functools.partial(method, *args, **kwargs))
+    return wrapper
 
-    def __del__(self):
-        if hasattr(self, 'conn'):
-            self.conn.close()
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Database closed")
 
-    def create_tables(self) -> None:
-        cursor = self.conn.cursor()
-        cursor.executescript('''
-            CREATE TABLE IF NOT EXISTS `images` (
-                `id` INTEGER PRIMARY KEY,
-                `uuid` TEXT NOT NULL DEFAULT "",
-                `filename` TEXT NOT NULL DEFAULT "",
-                `path` TEXT NOT NULL DEFAULT "",
-                `thumbnail` TEXT NOT NULL DEFAULT "",
-                `caption` TEXT DEFAULT NULL,
-                `location` TEXT DEFAULT NULL
-            );
+class Database:
+
+    def __init__(self, dbfile: str, cache_size: int = 1024, readers: int = 4):
+        # SQLite allows concurrent readers in WAL mode but only one writer at a time
+        self.dbfile = dbfile
+        self.readers_count = readers
+        self.writer_conn = None
+        self.writer_lock = threading.Lock()
+        self.readers = queue.Queue()
+        # LRU cache of select_by_uuid(), a cache_size of None or 0 disables it
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size or 0
+        self.cache_lock = threading.Lock()
+        # Bumped on every invalidation, so that a read started before it is not cached
+        self.cache_generation = 0
+
+    @in_executor
+    def open(self) -> None:
+        self.writer_conn = self.connect(self.dbfile)
+        self.create_tables()
+        for _ in range(self.readers_count):
+            self.readers.put(self.connect(self.dbfile))
+        logger.info('Database initialized (%s)', self.dbfile)
+
+    @in_executor
+    def close(self) -> None:
+        self.writer_conn.close()
+        while not self.readers.empty():
+            self.readers.get_nowait().close()
+        logger.info('Database closed')
+
+    @staticmethod
+    def connect(dbfile: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(dbfile, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.executescript('''
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            PRAGMA temp_store = MEMORY;
+            PRAGMA cache_size = -64000;
+            PRAGMA mmap_size = 268435456;
         ''')
-        self.conn.commit()
+        return conn
 
-    def select(self) -> list:
-        cursor = self.conn.cursor()
-        cursor.execute('''SELECT * FROM `images` ORDER BY `id` DESC''')
-        return [{key: row[key] for key in row.keys()} for row in cursor.fetchall()]
+    @contextlib.contextmanager
+    def reader(self) -> sqlite3.Connection:
+        conn = self.readers.get()
+        try:
+            yield conn
+        finally:
+            self.readers.put(conn)
 
-    def select_by_uuid(self, image_uuid: str) -> dict:
-        cursor = self.conn.cursor()
-        cursor.execute('''SELECT * FROM `images` WHERE `uuid` = :image_uuid LIMIT 1''', { 'image_uuid': str(image_uuid) })
-        row = cursor.fetchone()
-        return {key: row[key] for key in row.keys()} if row is not None else None
+    @contextlib.contextmanager
+    def writer(self) -> sqlite3.Connection:
+        with self.writer_lock, self.writer_conn:
+            yield self.writer_conn
 
+    def create_tables(self) -> None:
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            cursor.executescript('''
+                CREATE TABLE IF NOT EXISTS `images` (
+                    `id` INTEGER PRIMARY KEY,
+                    `uuid` TEXT NOT NULL DEFAULT "",
+                    `filename` TEXT NOT NULL DEFAULT "",
+                    `path` TEXT NOT NULL DEFAULT "",
+                    `thumbnail` TEXT NOT NULL DEFAULT "",
+                    `caption` TEXT DEFAULT NULL,
+                    `location` TEXT DEFAULT NULL,
+                    `width` INTEGER DEFAULT NULL,
+                    `height` INTEGER DEFAULT NULL,
+                    `format` TEXT DEFAULT NULL,
+                    `size` INTEGER DEFAULT NULL,
+                    `taken_at` INTEGER DEFAULT NULL,
+                    `exif` TEXT DEFAULT NULL
+                );
+                CREATE UNIQUE INDEX IF NOT EXISTS `ix_images_uuid` ON `images` (`uuid`);
+            ''')
+            columns = [row['name'] for row in cursor.execute('PRAGMA table_info(`images`)').fetchall()]
+            for column, definition in [('width', 'INTEGER'), ('height', 'INTEGER'), ('format', 'TEXT'), ('size', 'INTEGER'), ('taken_at', 'INTEGER'), ('exif', 'TEXT')]:
+                if column not in columns:
+                    cursor.execute(f'ALTER TABLE `images` ADD COLUMN `{column}` {definition} DEFAULT NULL')
+
+    @in_executor
+    def select(self) -> list:
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            # An empty thumbnail is still being generated, the image itself is shown meanwhile
+            cursor.execute('''SELECT `uuid`, COALESCE(NULLIF(`thumbnail`, ''), `path`) AS `thumbnail` FROM `images` ORDER BY `id` DESC''')
+            return cursor.fetchall()
+
+    async def select_by_uuid(self, image_uuid: str) -> dict:
+        image_uuid = str(image_uuid)
+        with self.cache_lock:
+            if image_uuid in self.cache:
+                self.cache.move_to_end(image_uuid)
+                return dict(self.cache[image_uuid])
+            generation = self.cache_generation
+
+        data = await self._select_by_uuid(image_uuid)
+        with self.cache_lock:
+            # Do not cache a row that has been modified while it was being read
+            if data is not None and self.cache_size > 0 and generation == self.cache_generation:
+                self.cache[image_uuid] = data
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return dict(data) if data is not None else None
+
+    def uncache(self, image_uuid: str) -> None:
+        with self.cache_lock:
+            self.cache.pop(str(image_uuid), None)
+            self.cache_generation += 1
+
+    @in_executor
+    def _select_by_uuid(self, image_uuid: str) -> dict:
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''SELECT * FROM `images` WHERE `uuid` = :image_uuid LIMIT 1''', { 'image_uuid': image_uuid })
+            row = cursor.fetchone()
+            return dict(row) if row is not None else None
+
+    @in_executor
+    def select_pending_thumbnails(self) -> list:
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''SELECT `uuid`, `path` FROM `images` WHERE `thumbnail` = '' ORDER BY `id` ASC''')
+            return cursor.fetchall()
+
+    @in_executor
     def select_hashtag(self, hashtag: str) -> list:
-        cursor = self.conn.cursor()
-        cursor.execute('''SELECT * FROM `images` WHERE `caption` LIKE :hashtag ORDER BY `id` DESC''', {
-            'hashtag': f"%#{hashtag}%"
-        })
-        return [{key: row[key] for key in row.keys()} for row in cursor.fetchall()]
-
-    def insert(self, image_uuid: str, filename: str, path: str, thumbnail: str, caption: str = '', location: str = '') -> None:
-        cursor = self.conn.cursor()
-        cursor.execute('INSERT INTO `images` (`uuid`, `filename`, `path`, `thumbnail`, `caption`, `location`) VALUES (:image_uuid, :filename, :path, :thumbnail, :caption, :location)', {
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''SELECT `uuid`, COALESCE(NULLIF(`thumbnail`, ''), `path`) AS `thumbnail` FROM `images` WHERE `caption` LIKE :hashtag ORDER BY `id` DESC''', {
+                'hashtag': f"%#{hashtag}%"
+            })
+            return cursor.fetchall()
+
+    @in_executor
+    def count_captions(self) -> list:
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''SELECT `caption`, COUNT(*) AS `count` FROM `images` WHERE `caption` LIKE '%#%' GROUP BY `caption` ORDER BY MAX(`id`) DESC''')
+            return [(row['caption'], row['count']) for row in cursor.fetchall()]
+
+    @in_executor
+    def insert(self, image_uuid: str, filename: str, path: str, thumbnail: str, caption: str = '', location: str = '', metadata: dict = None) -> None:
+        self._insert([(image_uuid, filename, path, thumbnail, caption, location, metadata)])
+
+    @in_executor
+    def insert_many(self, images: list) -> None:
+        # Each image is a tuple of insert() arguments, all of them are committed at once
+        self._insert(images)
+
+    def _insert(self, images: list) -> None:
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            cursor.executemany('INSERT INTO `images` (`uuid`, `filename`, `path`, `thumbnail`, `caption`, `location`, `width`, `height`, `format`, `size`, `taken_at`, `exif`) VALUES (:image_uuid, :filename, :path, :thumbnail, :caption, :location, :width, :height, :format, :size, :taken_at, :exif)', [
+                self._insert_params(*image) for image in images
+            ])
+        for image in images:
+            logger.info('New image %s (%s)', image[1], image[0])
+
+    @staticmethod
+    def _insert_params(image_uuid: str, filename: str, path: str, thumbnail: str, caption: str = '', location: str = '', metadata: dict = None) -> dict:
+        metadata = metadata if metadata is not None else dict()
+        return {
             'image_uuid': str(image_uuid),
             'filename': str(filename),
             'path': str(path),
             'thumbnail': str(thumbnail),
             'caption': str(caption),
-            'location': str(location)
-        })
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] New image {filename} ({image_uuid})")
-        self.conn.commit()
-
+            'location': str(location),
+            'width': metadata.get('width'),
+            'height': metadata.get('height'),
+            'format': metadata.get('format'),
+            'size': metadata.get('size'),
+            'taken_at': metadata.get('taken_at'),
+            'exif': orjson.dumps(metadata.get('exif'), option=orjson.OPT_NON_STR_KEYS).decode() if 'exif' in metadata else None
+        }
+
+    @in_executor
     def update(self, image_uuid: str, caption: str = '', location: str = '') -> None:
-        cursor = self.conn.cursor()
-        cursor.execute('UPDATE `images` SET `caption` = :caption, `location` = :location WHERE `uuid` = :image_uuid', {
-            'image_uuid': str(image_uuid),
-            'caption': str(caption),
-            'location': str(location)
-        })
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Update image {image_uuid}")
-        self.conn.commit()
-
-    def delete(self, image_uuid: str) -> None:
-        cursor = self.conn.cursor()
-        cursor.execute('DELETE FROM `images` WHERE `uuid` = :image_uuid', {
-            'image_uuid': str(image_uuid)
-        })
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Delete image {image_uuid}")
-        self.conn.commit()
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute('UPDATE `images` SET `caption` = :caption, `location` = :location WHERE `uuid` = :image_uuid', {
+                'image_uuid': str(image_uuid),
+                'caption': str(caption),
+                'location': str(location)
+            })
+        logger.info('Update image %s', image_uuid)
+        self.uncache(image_uuid)
+
+    @in_executor
+    def update_thumbnail(self, image_uuid: str, thumbnail: str) -> bool:
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute('UPDATE `images` SET `thumbnail` = :thumbnail WHERE `uuid` = :image_uuid', {
+                'image_uuid': str(image_uuid),
+                'thumbnail': str(thumbnail)
+            })
+            updated = cursor.rowcount > 0
+        self.uncache(image_uuid)
+        return updated
+
+    @in_executor
+    def update_metadata(self, image_uuid: str, metadata: dict) -> None:
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute('UPDATE `images` SET `width` = :width, `height` = :height, `format` = :format, `size` = :size, `taken_at` = :taken_at, `exif` = :exif WHERE `uuid` = :image_uuid', {
+                'image_uuid': str(image_uuid),
+                'width': metadata.get('width'),
+                'height': metadata.get('height'),
+                'format': metadata.get('format'),
+                'size': metadata.get('size'),
+                'taken_at': metadata.get('taken_at'),
+                'exif': orjson.dumps(metadata.get('exif'), option=orjson.OPT_NON_STR_KEYS).decode()
+            })
+        self.uncache(image_uuid)
+
+    @in_executor
+    def delete(self, image_uuid: str, before_commit=None) -> dict:
+        # The deleted row is read in the same transaction, so its thumbnail is the latest one,
+        # and the row is kept when before_commit(row) (e.g. moving its files) fails
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT `path`, `thumbnail` FROM `images` WHERE `uuid` = :image_uuid', {
+                'image_uuid': str(image_uuid)
+            })
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            cursor.execute('DELETE FROM `images` WHERE `uuid` = :image_uuid', {
+                'image_uuid': str(image_uuid)
+            })
+            if before_commit is not None:
+                before_commit(dict(row))
+        logger.info('Delete image %s', image_uuid)
+        self.uncache(image_uuid)
+        return dict(row) if row is not None else None
 
 
 locale.setlocale(locale.LC_ALL, ('fr_FR', 'UTF-8'))
 routes = aiohttp.web.RouteTableDef()
-db = Database(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'picture.sqlite')))
-upload_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'media')
-trash_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'trash')
+base_dir = os.path.dirname(os.path.abspath(__file__))
+data_dir = os.path.join(base_dir, '..', 'data')
+db = Database(os.path.abspath(os.path.join(data_dir, 'picture.sqlite')))
+upload_dir = os.path.join(base_dir, '..', 'media')
+trash_dir = os.path.join(base_dir, '..', 'trash')
+cpu_count = os.cpu_count() or 1
+pool = concurrent.futures.ProcessPoolExecutor(max_workers=cpu_count)
+thumbnail_queue_key = aiohttp.web.AppKey('thumbnail_queue', asyncio.Queue)
+thumbnail_workers_key = aiohttp.web.AppKey('thumbnail_workers', list)
 
 os.makedirs(upload_dir, exist_ok=True)
 os.makedirs(trash_dir, exist_ok=True)
 
+max_upload_size = 64 * 1024 ** 2
+allowed_extensions = frozenset(('jpeg', 'jpg', 'png', 'gif'))
+allowed_content_types = frozenset(('image/jpeg', 'image/jpg', 'image/png', 'image/gif'))
 token = os.environ["PICTURE_TOKEN"] if "PICTURE_TOKEN" in os.environ else False
+hashtag_pattern = re.compile(r'#(\w+)')
+exif_tags = ExifTags.TAGS
+jpeg_formats = ('JPEG', 'MPO')
+# JPEG is also the only format whose EXIF is read, both names are kept for what they are used for
+exif_formats = jpeg_formats
+accel_redirect = os.environ["PICTURE_ACCEL_REDIRECT"] if "PICTURE_ACCEL_REDIRECT" in os.environ else False
 
 @routes.get('/')
 @aiohttp_jinja2.template('index.jinja2')
 async def handle_index(request: 'aiohttp.web.Request') -> dict:
     session = await aiohttp_session.get_session(request)
 
-    pictures = db.select() if request.query.get('hashtag', None) is None else db.select_hashtag(request.query.get('hashtag'))
+    current_tag = request.query.get('hashtag', None)
+    pictures, captions = await asyncio.gather(
+        db.select() if current_tag is None else db.select_hashtag(current_tag),
+        db.count_captions()
+    )
     
-    hashtags = dict()
-    for tag in [m.group(1) for data in db.select() for m in re.finditer(r'#(\w+)', str(data.get('caption')))]:
-        hashtags[tag] = hashtags.get(tag, 0) + 1
-    hashtags = sorted(hashtags, key=hashtags.__getitem__, reverse=True)
+    hashtags = collections.Counter()
+    for caption, count in captions:
+        for tag in hashtag_pattern.findall(caption):
+            hashtags[tag] += count
+    hashtags = [tag for tag, _ in hashtags.most_common()]
 
     return {
         'is_authenticated': session.get('token', None) == token,
         'token_is_not_set': token is False,
         'pictures': pictures,
         'hashtags': hashtags,
-        'current_tag': request.query.get('hashtag'),
+        'current_tag': current_tag,
     }
 
 
@@ -159,29 +374,36 @@ async def handle_index(request: 'aiohttp.web.Request') -> dict:
 async def handle_page(request: 'aiohttp.web.Request') -> dict:
     session = await aiohttp_session.get_session(request)
 
-    data = db.select_by_uuid(request.match_info.get('image_uuid', None))
-    if data is None or not os.path.isfile(os.path.join(upload_dir, data.get('path'))):
+    data = await db.select_by_uuid(request.match_info.get('image_uuid', None))
+    if data is None:
+        raise aiohttp.web.HTTPNotFound()
+
+    # Only the existence of the file is checked, its size and date are stored at upload
+    if not os.path.isfile(os.path.join(upload_dir, data.get('path'))):
         raise aiohttp.web.HTTPNotFound()
 
-    try:
-        image = Image.open(os.path.join(upload_dir, data.get('path')))
-    except:
-        raise aiohttp.web.HTTPInternalServerError()
-
-    data['stat'] = os.stat(os.path.join(upload_dir, data.get('path')))
-    if image.format.lower() in ('jpg', 'jpeg'):
-        exif = image._getexif() if image._getexif() is not None else dict()
-        data = { **{ExifTags.TAGS.get(tag, tag): value for tag, value in exif.items()}, **data }
-        data['Focal'] = int(data.get('FocalLength', (0, 1))[0] / data.get('FocalLength', (0, 1))[1])
-        data['Opening'] = round(data.get('FNumber', (0, 1))[0] / data.get('FNumber', (0, 1))[1], 1)
+    # Images stored before size and date were recorded are read again once
+    if data.get('size') is None:
+        try:
+            metadata = await asyncio.get_event_loop().run_in_executor(pool, image_metadata, *os.path.split(data.get('path')))
+        except FileNotFoundError:
+            raise aiohttp.web.HTTPNotFound()
+        except:
+            raise aiohttp.web.HTTPInternalServerError()
+        await db.update_metadata(data.get('uuid'), metadata)
+        data.update(metadata)
+    else:
+        data['exif'] = orjson.loads(data.get('exif') or '{}')
+
+    data = { **data.pop('exif'), **data }
+    if data.get('format') in exif_formats:
+        focal, opening = exif_rational(data.get('FocalLength')), exif_rational(data.get('FNumber'))
+        data['Focal'] = int(focal[0] / focal[1])
+        data['Opening'] = round(opening[0] / opening[1], 1)
+        data['ExposureTime'] = exif_rational(data.get('ExposureTime'), None)
     data['root'], data['extension'] = os.path.splitext(data.get('path'))
-    data['width'], data['height'], data['info'], data['format'] = image.width, image.height, image.info, image.format
     data['resolution'] = round(data.get('width', 0) * data.get('height', 0) / 1000000, 1)
-    data['weight'] = si_prefix.si_format(data['stat'].st_size, precision=1)
-    try:
-        data['localtime'] = time.strptime(data.get('DateTime', ''), '%Y:%m:%d %H:%M:%S')
-    except ValueError:
-        data['localtime'] = time.localtime(data['stat'].st_ctime)
+    data['localtime'] = time.localtime(data.get('taken_at'))
     data['date'] = time.strftime('%d %B %Y', data['localtime'])
     data['time'] = time.strftime('%a, %H:%M', data['localtime'])
 
@@ -198,12 +420,12 @@ async def handle_edition(request: 'aiohttp.web.Request') -> 'aiohttp.web.Respons
     if session.get('token', None) != token:
         raise aiohttp.web.HTTPUnauthorized()
 
-    data = db.select_by_uuid(request.match_info.get('image_uuid', None))
+    data = await db.select_by_uuid(request.match_info.get('image_uuid', None))
     if data is None:
         raise aiohttp.web.HTTPNotFound()
 
     post = await request.post()
-    db.update(data.get('uuid'), post.get('caption', ''), post.get('location', ''))
+    await db.update(data.get('uuid'), post.get('caption', ''), post.get('location', ''))
 
     return aiohttp.web.HTTPFound(f"/p/{data.get('uuid')}")
 
@@ -214,16 +436,11 @@ async def handle_deletion(request: 'aiohttp.web.Request') -> 'aiohttp.web.Respon
     if session.get('token', None) != token:
         raise aiohttp.web.HTTPUnauthorized()
 
-    data = db.select_by_uuid(request.match_info.get('image_uuid', None))
+    # The files are moved before the deletion is committed, so that no image is left without its row
+    data = await db.delete(request.match_info.get('image_uuid', None), move_image_to_trash)
     if data is None:
         raise aiohttp.web.HTTPNotFound()
 
-    if os.path.isfile(os.path.join(upload_dir, data.get('path'))):
-        shutil.move(os.path.join(upload_dir, data.get('path')), os.path.join(trash_dir, os.path.basename(data.get('path'))))
-    if os.path.isfile(os.path.join(upload_dir, data.get('thumbnail'))):
-        shutil.move(os.path.join(upload_dir, data.get('thumbnail')), os.path.join(trash_dir, os.path.basename(data.get('thumbnail'))))
-    db.delete(request.match_info.get('image_uuid', None))
-
     return aiohttp.web.HTTPAccepted()
 
 
@@ -233,7 +450,7 @@ async def handle_signin(request: 'aiohttp.web.Request') -> 'aiohttp.web.Response
     if post.get('token', None) == token:
         session = await aiohttp_session.new_session(request)
         session['token'] = post.get('token')
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Successfully authenticated from {request.remote}")
+        logger.info('Successfully authenticated from %s', request.remote)
     return aiohttp.web.HTTPFound(f"/p/{post.get('uuid')}" if post.get('uuid', False) else '/')
 
 
@@ -251,28 +468,72 @@ async def handle_store(request: 'aiohttp.web.Request') -> 'aiohttp.web.Response'
     if session.get('token', None) != token:
         raise aiohttp.web.HTTPFound('/login')
 
-    post = await request.post()
-    upload = post.get('image')
+    post, filename = dict(), None
+    reader = await request.multipart()
+    while True:
+        field = await reader.next()
+        if field is None:
+            break
+
+        if field.name in ('caption', 'location'):
+            post[field.name] = await field.text()
+            continue
+        elif field.name != 'image' or filename is not None:
+            await field.release()
+            continue
+
+        extension = str(field.filename).rpartition('.')[2].lower()
+        if field.headers.get(aiohttp.hdrs.CONTENT_TYPE) not in allowed_content_types or extension not in allowed_extensions:
+            raise aiohttp.web.HTTPBadRequest()
+
+        image_uuid = uuid.uuid4()
+        original_filename = field.filename
+        filename = f"{image_uuid.hex}.{extension}"
+        now = time.localtime()
+        path = os.path.join(f"{now.tm_year:04d}", f"{now.tm_mon:02d}")
+        full_path = os.path.join(upload_dir, path, filename)
+
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        try:
+            size = 0
+            async with aiofiles.open(full_path, 'wb') as file:
+                while True:
+                    chunk = await field.read_chunk(64 * 1024)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > max_upload_size:
+                        raise aiohttp.web.HTTPRequestEntityTooLarge(max_upload_size, size)
+                    await file.write(chunk)
+        except:
+            os.remove(full_path)
+            raise
 
-    if upload.content_type not in ('image/jpeg', 'image/jpg', 'image/png', 'image/gif'):
+    if filename is None:
         raise aiohttp.web.HTTPBadRequest()
 
-    if upload.filename.split('.')[-1].lower() not in ('jpeg', 'jpg', 'png', 'gif'):
-        raise aiohttp.web.HTTPBadRequest()
+    loop = asyncio.get_event_loop()
+    metadata = await loop.run_in_executor(pool, image_metadata, path, filename)
 
-    image_uuid = uuid.uuid4()
-    filename = f"{hashlib.md5(image_uuid.bytes).hexdigest()}.{upload.filename.split('.')[-1].lower()}"
-    path = os.path.join(time.strftime('%Y'), time.strftime('%m'))
+    image_path = os.path.join(path, filename)
 
-    os.makedirs(os.path.join(upload_dir, path), exist_ok=True)
-    with open(os.path.join(upload_dir, path, filename), 'wb') as file:
-        file.write(upload.file.read())
+    # The thumbnail is left empty until a worker has generated it
+    await db.insert(image_uuid, original_filename, image_path, '', post.get('caption', ''), post.get('location', ''), metadata)
+    await request.app[thumbnail_queue_key].put((image_uuid, path, filename))
 
-    thumbnail = image_thumbnail(path, filename, 384)
+    return aiohttp.web.HTTPFound(f'/p/{image_uuid}')
 
-    db.insert(image_uuid, upload.filename, os.path.join(path, filename), thumbnail, post.get('caption', ''), post.get('location', ''))
 
-    return aiohttp.web.HTTPFound(f'/p/{image_uuid}')
+async def handle_media(request: 'aiohttp.web.Request') -> 'aiohttp.web.Response':
+    path = os.path.normpath(request.match_info.get('path', ''))
+    if path.startswith('..') or os.path.isabs(path):
+        raise aiohttp.web.HTTPNotFound()
+
+    # Let the reverse proxy send the file itself from its internal location
+    return aiohttp.web.Response(headers={
+        'X-Accel-Redirect': f"{accel_redirect.rstrip('/')}/{urllib.parse.quote(path)}",
+        'Content-Type': mimetypes.guess_type(path)[0] or 'application/octet-stream',
+    })
 
 
 async def handle_400(request: 'aiohttp.web.Request') -> 'aiohttp.web.Response':
@@ -287,21 +548,126 @@ async def handle_500(request: 'aiohttp.web.Request') -> 'aiohttp.web.Response':
     return aiohttp_jinja2.render_template('errors/500.html', request, {})
 
 
+def move_image_to_trash(data: dict) -> None:
+    # The thumbnail is empty until it has been generated, and the image itself when it is small enough
+    move_to_trash([path for path in dict.fromkeys([data.get('path'), data.get('thumbnail')]) if path])
+
+
+def move_to_trash(paths: list) -> None:
+    for path in paths:
+        source, destination = os.path.join(upload_dir, path), os.path.join(trash_dir, os.path.basename(path))
+        try:
+            os.replace(source, destination)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # Fall back to a copy when the trash is on another filesystem (or another Docker volume)
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.move(source, destination)
+
+
 def image_thumbnail(path: str, filename: str, square: int = 150) -> str:
-    image = Image.open(os.path.join(upload_dir, path, filename))
-    root, extension = os.path.splitext(os.path.basename(image.filename))
-    width, height = image.size
-    if image.width > square and image.height > square:
-        if width < height:
-            image = image.crop((0, int(math.floor((height - width) / 2)), width, int(height - math.ceil((height - width) / 2))))
-        elif width > height:
-            image = image.crop((int(math.floor((width - height) / 2)), 0, int(width - math.ceil((width - height) / 2)), height))
-        image.thumbnail((square, square), Image.ANTIALIAS)
-        image.save(os.path.join(upload_dir, path, f"{root}-{square}x{square}.{extension.lstrip('.')}"), image.format)
-        return os.path.join(path, f"{root}-{square}x{square}.{extension.lstrip('.')}")
+    with Image.open(os.path.join(upload_dir, path, filename)) as image:
+        root, extension = os.path.splitext(os.path.basename(image.filename))
+        if image.width > square and image.height > square:
+            image_format = image.format
+            image.draft(image.mode, (square, square))
+            side = min(image.size)
+            box = ((image.width - side) / 2, (image.height - side) / 2, (image.width + side) / 2, (image.height + side) / 2)
+            image = image.resize((square, square), Image.LANCZOS, box=box, reducing_gap=3.0)
+            thumbnail = os.path.join(path, f"{root}-{square}x{square}.{extension.lstrip('.')}")
+            if image_format in jpeg_formats:
+                image.save(os.path.join(upload_dir, thumbnail), 'JPEG', quality=85, optimize=True, progressive=True)
+            else:
+                image.save(os.path.join(upload_dir, thumbnail), image_format)
+            return thumbnail
     return os.path.join(path, filename)
 
 
+async def thumbnail_worker(app: aiohttp.web.Application) -> None:
+    loop = asyncio.get_event_loop()
+    while True:
+        image_uuid, path, filename = await app[thumbnail_queue_key].get()
+        try:
+            try:
+                thumbnail = await loop.run_in_executor(pool, image_thumbnail, path, filename, 384)
+            except Exception as e:
+                # The image itself is kept as its thumbnail so that the job is not retried on every start
+                logger.error('Thumbnail failed for image %s (%s)', image_uuid, e)
+                thumbnail = os.path.join(path, filename)
+            if not await db.update_thumbnail(image_uuid, thumbnail) and thumbnail != os.path.join(path, filename):
+                # The image has been deleted while its thumbnail was being generated
+                await loop.run_in_executor(None, move_to_trash, [thumbnail])
+        except Exception as e:
+            logger.error('Thumbnail update failed for image %s (%s)', image_uuid, e)
+        finally:
+            app[thumbnail_queue_key].task_done()
+
+
+async def open_database(app: aiohttp.web.Application) -> None:
+    await db.open()
+
+
+async def close_database(app: aiohttp.web.Application) -> None:
+    await db.close()
+
+
+async def start_thumbnail_workers(app: aiohttp.web.Application) -> None:
+    app[thumbnail_queue_key] = asyncio.Queue()
+    # Thumbnails still pending when the application last stopped are generated again
+    for row in await db.select_pending_thumbnails():
+        app[thumbnail_queue_key].put_nowait((row['uuid'], *os.path.split(row['path'])))
+    app[thumbnail_workers_key] = [asyncio.get_event_loop().create_task(thumbnail_worker(app)) for _ in range(cpu_count)]
+
+
+async def stop_thumbnail_workers(app: aiohttp.web.Application) -> None:
+    for worker in app[thumbnail_workers_key]:
+        worker.cancel()
+    await asyncio.gather(*app[thumbnail_workers_key], return_exceptions=True)
+
+
+async def shutdown_pool(app: aiohttp.web.Application) -> None:
+    pool.shutdown()
+
+
+def image_metadata(path: str, filename: str) -> dict:
+    # Only the header and the EXIF segment are read, the pixels are never decoded
+    with Image.open(os.path.join(upload_dir, path, filename)) as image:
+        exif = image._getexif() if image.format in exif_formats else None
+        metadata = { 'width': image.width, 'height': image.height, 'format': image.format, 'exif': dict() }
+    for tag, value in (exif if exif is not None else dict()).items():
+        value = exif_value(value)
+        if value is not None:
+            metadata['exif'][exif_tags.get(tag, tag)] = value
+    stat = os.stat(os.path.join(upload_dir, path, filename))
+    metadata['size'] = stat.st_size
+    try:
+        metadata['taken_at'] = int(time.mktime(time.strptime(metadata['exif'].get('DateTime', ''), '%Y:%m:%d %H:%M:%S')))
+    except (TypeError, ValueError, OverflowError):
+        metadata['taken_at'] = int(stat.st_ctime)
+    return metadata
+
+
+def exif_value(value):
+    # Keep only JSON serializable values, rationals are stored as (numerator, denominator)
+    if isinstance(value, TiffImagePlugin.IFDRational):
+        return (value.numerator, value.denominator)
+    if isinstance(value, tuple):
+        values = [exif_value(item) for item in value]
+        return tuple(values) if None not in values else None
+    if isinstance(value, str):
+        return value.strip('\x00')
+    return value if isinstance(value, (int, float)) else None
+
+
+def exif_rational(value, default=(0, 1)):
+    # Rationals such as 0/0 are common in EXIF (e.g. FNumber of manual lenses)
+    if isinstance(value, (list, tuple)) and len(value) == 2 and all(isinstance(item, int) for item in value) and value[1] != 0:
+        return tuple(value)
+    return default
+
+
 def create_error_middleware(overrides):
     @aiohttp.web.middleware
     async def error_middleware(request, handler):
@@ -319,14 +685,54 @@ def create_error_middleware(overrides):
     return error_middleware
 
 
+def si_format(value: int, precision: int = 1) -> str:
+    exponent = 0
+    while abs(value) >= 1000 ** (exponent + 1) and exponent < 8:
+        exponent += 1
+    if exponent < 8 and round(abs(value) / 1000 ** exponent, precision) >= 1000:
+        exponent += 1
+    return f"{value / 1000 ** exponent:.{precision}f} {' kMGTPEZY'[exponent].strip()}"
+
+
+def load_secret_key(filename: str) -> bytes:
+    # The key is shared by every worker and survives restarts, so existing sessions stay valid
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.session.key.')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(cryptography.fernet.Fernet.generate_key())
+        # The key file only appears once it is complete, and only the first worker creates it
+        os.link(temporary, filename)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(temporary)
+    with open(filename, 'rb') as file:
+        try:
+            secret_key = base64.urlsafe_b64decode(file.read())
+        except ValueError:
+            secret_key = b''
+    if len(secret_key) != 32:
+        raise ValueError(f'Invalid session key in {filename}, delete the file to generate a new one')
+    return secret_key
+
+
 def make_app() -> aiohttp.web.Application:
-    app = aiohttp.web.Application(client_max_size=64 * 1024 ** 2)
-    secret_key = base64.urlsafe_b64decode(cryptography.fernet.Fernet.generate_key())
+    app = aiohttp.web.Application(client_max_size=max_upload_size)
+    secret_key = load_secret_key(os.path.join(data_dir, 'session.key'))
     aiohttp_session.setup(app, aiohttp_session.cookie_storage.EncryptedCookieStorage(secret_key))
-    aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')))
-    app.router.add_static('/static', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
-    app.router.add_static('/media', upload_dir)
+    aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader(os.path.join(base_dir, 'templates')), filters={ 'si_format': si_format })
+    app.router.add_static('/static', os.path.join(base_dir, 'static'))
+    if accel_redirect:
+        app.router.add_get('/media/{path:.+}', handle_media)
+    else:
+        # Files are sent with sendfile(2) by aiohttp unless AIOHTTP_NOSENDFILE is set
+        app.router.add_static('/media', upload_dir, show_index=False, follow_symlinks=False)
     app.router.add_routes(routes)
+    app.on_startup.append(open_database)
+    app.on_startup.append(start_thumbnail_workers)
+    app.on_cleanup.append(stop_thumbnail_workers)
+    app.on_cleanup.append(close_database)
+    app.on_cleanup.append(shutdown_pool)
     #app.middlewares.append(create_error_middleware({ 400: handle_400, 404: handle_404, 500: handle_500 }))
     return app
 